@@ -3,7 +3,9 @@
 import os
 import random
 import sklearn
+import functools
 import collections
+import concurrent.futures
 
 from rdkit import Chem
 from rdkit.Chem import rdDepictor
@@ -21,6 +23,22 @@ from MolRep.Utils.utils import *
 GREEN_COL = (0, 1, 0)
 RED_COL = (1, 0, 0)
 
+# preprocessed attribution sets kept per experiment, enough for the test and the full SMILES lists
+_ATT_CACHE_SIZE = 2
+
+
+@functools.lru_cache(maxsize=4096)
+def _mol_from_smiles(smiles):
+    # Cached molecules are shared between callers, take a `Chem.Mol` copy before mutating.
+    # The cache is bounded so that large datasets do not keep every parsed molecule alive.
+    return Chem.MolFromSmiles(smiles)
+
+
+def _flatten(att_list):
+    """Concatenates per-molecule arrays, returning the flat buffer and the offsets delimiting each molecule."""
+    offsets = np.cumsum([0] + [len(att) for att in att_list])
+    return np.concatenate(att_list), offsets
+
 
 class ExplainerExperiments:
 
@@ -28,6 +46,8 @@ class ExplainerExperiments:
         self.model_config = Config.from_dict(model_configuration) if isinstance(model_configuration, dict) else model_configuration
         self.dataset_config = dataset_config
         self.exp_path = exp_path
+        # preprocessed attributions keyed by the identity of the importances and the SMILES they came from
+        self._att_probs_cache = collections.OrderedDict()
 
         if not os.path.exists(exp_path):
             os.makedirs(exp_path)
@@ -38,26 +58,26 @@ class ExplainerExperiments:
         This function returns the training and test accuracy. DO NOT USE THE TEST FOR TRAINING OR EARLY STOPPING!
         :return: (training accuracy, test accuracy)
         """
-        shuffle = self.model_config['shuffle'] if 'shuffle' in self.model_config else True
+        mc = self.model_config
+        shuffle = mc['shuffle'] if 'shuffle' in mc else True
+        batch_size = mc['batch_size']
+        lr = mc['learning_rate']
+        wd = mc['l2']
 
-        model_class = self.model_config.model
-        optim_class = self.model_config.optimizer
-        stopper_class = self.model_config.early_stopper
-        clipping = self.model_config.gradient_clipping
-
-        loss_fn = get_loss_func(self.dataset_config['task_type'], self.model_config.exp_name)
-        shuffle = self.model_config['shuffle'] if 'shuffle' in self.model_config else True
+        model_class = mc.model
+        optim_class = mc.optimizer
+        stopper_class = mc.early_stopper
+        clipping = mc.gradient_clipping
 
+        loss_fn = get_loss_func(self.dataset_config['task_type'], mc.exp_name)
 
-        train_loader, scaler = dataset.get_train_loader(self.model_config['batch_size'],
-                                                        shuffle=shuffle)
+        train_loader, scaler = dataset.get_train_loader(batch_size, shuffle=shuffle)
 
-        model = model_class(dim_features=dataset.dim_features, dim_target=dataset.dim_target, model_configs=self.model_config, dataset_configs=self.dataset_config)
-        net = ExplainerNetWrapper(model, attribution, dataset_configs=self.dataset_config, model_config=self.model_config,
+        model = model_class(dim_features=dataset.dim_features, dim_target=dataset.dim_target, model_configs=mc, dataset_configs=self.dataset_config)
+        net = ExplainerNetWrapper(model, attribution, dataset_configs=self.dataset_config, model_config=mc,
                                   loss_function=loss_fn)
-        optimizer = optim_class(model.parameters(),
-                                lr=self.model_config['learning_rate'], weight_decay=self.model_config['l2'])
-        scheduler = build_lr_scheduler(optimizer, model_configs=self.model_config, num_samples=dataset.num_samples)
+        optimizer = optim_class(model.parameters(), lr=lr, weight_decay=wd)
+        scheduler = build_lr_scheduler(optimizer, model_configs=mc, num_samples=dataset.num_samples)
 
         train_loss, train_metric, _, _, _, _, _ = net.train(train_loader=train_loader,
                                                             optimizer=optimizer, scheduler=scheduler,
@@ -90,38 +110,26 @@ class ExplainerExperiments:
 
         return results, atom_importance, bond_importance
 
-    def visualization(self, dataset, atom_importance, bond_importance, threshold=1e-4, set_weights=True, svg_dir=None, vis_factor=1.0, img_width=400, img_height=200, testing=True):
+    def visualization(self, dataset, atom_importance, bond_importance, threshold=1e-4, set_weights=True, svg_dir=None, vis_factor=1.0, img_width=400, img_height=200, testing=True, max_processes=None, recompute_coords=False):
 
         smiles_list = dataset.get_smiles_list(testing=testing)
         att_probs = self.preprocessing_attributions(smiles_list, atom_importance, bond_importance, normalizer='MinMaxScaler')
-        for idx, smiles in enumerate(smiles_list):
-            mol = Chem.MolFromSmiles(smiles)
-            cp = Chem.Mol(mol)
-            atom_imp = att_probs[idx]
-
-            highlightAtomColors, cp = self.determine_atom_col(cp, atom_imp, eps=0.1, set_weights=True)
-            highlightAtoms = list(highlightAtomColors.keys())
-
-            highlightBondColors = self.determine_bond_col(highlightAtomColors, mol)
-            highlightBonds = list(highlightBondColors.keys())
-
-            highlightAtomRadii = {
-                # k: np.abs(v) * vis_factor for k, v in enumerate(atom_imp)
-                k: 0.1 * vis_factor for k, v in enumerate(atom_imp)
-            }
-
-            rdDepictor.Compute2DCoords(cp, canonOrient=True)
-            drawer = rdMolDraw2D.MolDraw2DCairo(img_width, img_height)
-            drawer.DrawMolecule(
-                cp,
-                highlightAtoms=highlightAtoms,
-                highlightAtomColors=highlightAtomColors,
-                highlightAtomRadii=highlightAtomRadii,
-                highlightBonds=highlightBonds,
-                highlightBondColors=highlightBondColors,
-            )
-            drawer.FinishDrawing()
-            drawer.WriteDrawingText(os.path.join(svg_dir, f"{idx}.png"))
+
+        # Each molecule is drawn independently, so rendering is spread across worker processes
+        # while a few threads write the finished PNGs to disk. Workers get the SMILES rather than
+        # a pickled mol, pickling changes the canonical 2D coordinates RDKit computes.
+        render_args = ((smiles, att_probs[idx], img_width, img_height, vis_factor, set_weights, recompute_coords)
+                       for idx, smiles in enumerate(smiles_list))
+        png_paths = (os.path.join(svg_dir, f"{idx}.png") for idx in range(len(smiles_list)))
+        # with chunks of 16 molecules, no more than one worker per chunk can get work
+        num_workers = min(max_processes or os.cpu_count() or 1, -(-len(smiles_list) // 16))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as writer:
+            if num_workers <= 1:
+                list(writer.map(_write_bytes, png_paths, map(_render_one, render_args)))
+            else:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+                    pngs = pool.map(_render_one, render_args, chunksize=16)
+                    list(writer.map(_write_bytes, png_paths, pngs))
         #     svg = drawer.GetDrawingText().replace("svg:", "")
         #     svg = None
         #     svg_list.append(svg)
@@ -130,30 +138,54 @@ class ExplainerExperiments:
         return 
 
     def preprocessing_attributions(self, smiles_list, atom_importance, bond_importance, normalizer='MinMaxScaler'):
+        key = (id(atom_importance), id(bond_importance), tuple(smiles_list), normalizer)
+        cached = self._att_probs_cache.get(key)
+        # the cached entry holds references to its inputs, so their ids cannot be reused meanwhile
+        if cached is not None and cached[0] is atom_importance and cached[1] is bond_importance:
+            self._att_probs_cache.move_to_end(key)
+            return cached[2]
+
         att_probs = []
+        # multi-output attributions keep only the last output
+        multi = len(atom_importance) > 0 and np.ndim(atom_importance[0]) > 1
         for idx, smiles in enumerate(smiles_list):
-            mol = Chem.MolFromSmiles(smiles)
-            atom_imp = atom_importance[idx]
+            # copy, so the caller's importances are not modified by the bond contributions
+            atom_imp = np.array(atom_importance[idx], dtype=float)
 
             if bond_importance is not None:
+                mol = _mol_from_smiles(smiles)
                 bond_imp = bond_importance[idx]
 
-                bond_idx = []
-                for bond in mol.GetBonds():
-                    bond_idx.append((bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()))
-
-                for (atom_i_idx, atom_j_idx), b_imp in zip(bond_idx, bond_imp):
-                    atom_imp[atom_i_idx] += b_imp / 2
-                    atom_imp[atom_j_idx] += b_imp / 2
+                half = np.asarray(bond_imp, dtype=atom_imp.dtype) * 0.5
+                # explainers working on directed edges give two values per bond (len == 2 * num_bonds),
+                # only the first num_bonds are used, as zip over the bonds did
+                n = min(mol.GetNumBonds(), len(half))
+                half = half[:n]
+                if atom_imp.ndim > half.ndim:
+                    # one value per bond is spread over every output of multi-output atom importances
+                    half = half[:, None]
+
+                # index arrays cover the same n bonds as `half`
+                begin = np.empty(n, dtype=np.int32)
+                end = np.empty(n, dtype=np.int32)
+                for bond_idx, bond in zip(range(n), mol.GetBonds()):
+                    begin[bond_idx] = bond.GetBeginAtomIdx()
+                    end[bond_idx] = bond.GetEndAtomIdx()
+                # np.add.at accumulates correctly when an atom takes part in several bonds
+                np.add.at(atom_imp, begin, half)
+                np.add.at(atom_imp, end, half)
+
+            att_probs.append(atom_imp[:, -1] if multi else atom_imp)
 
-            att_probs.append(atom_imp)
-        
-        att_probs = [att[:, -1] if att_probs[0].ndim > 1 else att for att in att_probs]
-        
         att_probs = self.normalize_attributions(att_probs, normalizer)
+        # only the most recent attribution sets are kept, molecules stay in the bounded parse cache only
+        self._att_probs_cache[key] = (atom_importance, bond_importance, att_probs)
+        while len(self._att_probs_cache) > _ATT_CACHE_SIZE:
+            self._att_probs_cache.popitem(last=False)
         return att_probs
 
-    def determine_atom_col(self, cp, atom_importance, eps=1e-5, set_weights=True):
+    @staticmethod
+    def determine_atom_col(cp, atom_importance, eps=1e-5, set_weights=True):
         """ Colors atoms with positive and negative contributions
         as green and red respectively, using an `eps` absolute
         threshold.
@@ -178,18 +210,18 @@ class ExplainerExperiments:
         dict
             atom indexes with their assigned color
         """
-        atom_col = {}
-
-        for idx, v in enumerate(atom_importance):
-            if v > eps:
-                atom_col[idx] = RED_COL
-            if v < -eps:
-                atom_col[idx] = RED_COL
-                if set_weights:
-                    cp.GetAtomWithIdx(idx).SetProp("atomNote","%.3f"%(v))
+        atom_importance = np.asarray(atom_importance)
+        # positive and negative contributions currently share the same colour
+        atom_col = dict.fromkeys(np.flatnonzero(np.abs(atom_importance) > eps).tolist(), RED_COL)
+
+        if set_weights:
+            get_atom = cp.GetAtomWithIdx
+            for idx in np.flatnonzero(atom_importance < -eps).tolist():
+                get_atom(idx).SetProp("atomNote","%.3f"%(atom_importance[idx]))
         return atom_col, cp
 
-    def determine_bond_col(self, atom_col, mol):
+    @staticmethod
+    def determine_bond_col(atom_col, mol):
         """Colors bonds depending on whether the atoms involved
         share the same color.
 
@@ -204,13 +236,24 @@ class ExplainerExperiments:
         dict
             bond indexes with assigned color
         """
-        bond_col = {}
-
-        for idx, bond in enumerate(mol.GetBonds()):
-            atom_i_idx, atom_j_idx = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
-            if atom_i_idx in atom_col and atom_j_idx in atom_col:
-                if atom_col[atom_i_idx] == atom_col[atom_j_idx]:
-                    bond_col[idx] = atom_col[atom_i_idx]
+        num_bonds = mol.GetNumBonds()
+        begin_idx = np.fromiter((bond.GetBeginAtomIdx() for bond in mol.GetBonds()), dtype=np.int32, count=num_bonds)
+        end_idx = np.fromiter((bond.GetEndAtomIdx() for bond in mol.GetBonds()), dtype=np.int32, count=num_bonds)
+
+        # colour codes per atom, 0 meaning uncoloured. Codes are keyed on the colour value,
+        # so equal colours match once per atom rather than once per bond.
+        palette = {}
+        code_of = palette.setdefault
+        num_atoms = mol.GetNumAtoms()
+        col = np.zeros(num_atoms, dtype=np.int32)
+        for atom_idx, c in atom_col.items():
+            # indexes that are not atoms of `mol` colour no bond, as in the per-bond lookup
+            if 0 <= atom_idx < num_atoms:
+                col[atom_idx] = code_of(c, len(palette) + 1)
+
+        mask = (col[begin_idx] == col[end_idx]) & (col[begin_idx] != 0)
+        begin_list = begin_idx.tolist()
+        bond_col = {idx: atom_col[begin_list[idx]] for idx in np.flatnonzero(mask).tolist()}
         return bond_col
 
     def evaluate_attributions(self, dataset, atom_importance, bond_importance, binary=False):
@@ -228,7 +271,7 @@ class ExplainerExperiments:
                 att_metrics.attribution_accuracy(att_true, att_probs))
         else:
             opt_threshold = att_metrics.get_optimal_threshold(att_true, att_probs)
-            att_binary = [np.array([1 if att>opt_threshold else 0 for att in att_prob]) for att_prob in att_probs]
+            att_binary = [(att_prob > opt_threshold).astype(np.int8) for att_prob in att_probs]
 
             stats['ATT AUROC'] = np.nanmean(
                 att_metrics.attribution_auroc(att_true, att_probs))
@@ -244,25 +287,17 @@ class ExplainerExperiments:
         att_true_pair = dataset.get_attribution_truth()
         att_probs = self.preprocessing_attributions(smiles_list, atom_importance, bond_importance)
         
-        att_probs_reset, att_true = [], []
-        smiles_list = list(smiles_list)
-        for idx in range(len(att_true_pair)):
-            smiles_1 = att_true_pair[idx]['SMILES_1']
-            smiles_2 = att_true_pair[idx]['SMILES_2']
-
-            idx_1 = smiles_list.index(smiles_1)
-            idx_2 = smiles_list.index(smiles_2)
-
-            att_probs_reset.append(att_probs[idx_1])
-            att_true_1 = att_true_pair[idx]['attribution_1']
-            att_true.append(att_true_1)
+        # keep the first occurrence of duplicated SMILES, as `list.index` did
+        smi_to_idx = {}
+        for i, smiles in enumerate(smiles_list):
+            smi_to_idx.setdefault(smiles, i)
 
-            att_probs_reset.append(att_probs[idx_2])
-            att_true_2 = att_true_pair[idx]['attribution_2']
-            att_true.append(att_true_2)
+        # both molecules of each cliff pair, interleaved as (1, 2, 1, 2, ...)
+        att_probs_reset = [att_probs[smi_to_idx[pair[key]]] for pair in att_true_pair for key in ('SMILES_1', 'SMILES_2')]
+        att_true = [pair[key] for pair in att_true_pair for key in ('attribution_1', 'attribution_2')]
 
         opt_threshold = att_metrics.get_optimal_threshold(att_true, att_probs_reset, multi=True)
-        att_binary = [np.array([1 if att>0.5 else -1 if att<(-0.5) else 0 for att in att_prob]) for att_prob in att_probs_reset]
+        att_binary = [(att_prob > 0.5).astype(np.int8) - (att_prob < -0.5).astype(np.int8) for att_prob in att_probs_reset]
 
         stats = collections.OrderedDict()
         stats['ATT F1'] = np.nanmean(
@@ -273,16 +308,56 @@ class ExplainerExperiments:
 
     def normalize_attributions(self, att_list, positive = False, normalizer='MinMaxScaler'):
         """Normalize all nodes to 0 to 1 range via quantiles."""
-        all_values = np.concatenate(att_list)
-        all_values = all_values[all_values > 0] if positive else all_values
+        flat, offsets = _flatten(att_list)
+        values = flat[flat > 0] if positive else flat
 
         if normalizer == 'QuantileTransformer':
             normalizer = sklearn.preprocessing.QuantileTransformer()
+            normalizer.fit(values.reshape(-1, 1))
+            transformed = normalizer.transform(flat.reshape(-1, 1)).ravel()
         else:
-            normalizer = sklearn.preprocessing.MinMaxScaler()
-        normalizer.fit(all_values.reshape(-1, 1))
-        new_att = []
-        for att in att_list:
-            normed_nodes = normalizer.transform(att.reshape(-1, 1)).ravel()
-            new_att.append(normed_nodes)
+            # same result as sklearn's MinMaxScaler (no clipping, unit scale for a constant range)
+            lo, hi = float(values.min()), float(values.max())
+            scale = 1.0 / (hi - lo) if hi > lo else 1.0
+            transformed = (flat - lo) * scale
+        # per-molecule views into one contiguous buffer
+        new_att = [transformed[offsets[i]:offsets[i + 1]] for i in range(len(att_list))]
         return new_att
+
+
+def _render_one(args):
+    """Draws a single molecule with its highlighted attributions and returns the PNG bytes."""
+    smiles, atom_imp, img_width, img_height, vis_factor, set_weights, recompute_coords = args
+    mol = _mol_from_smiles(smiles)
+    cp = Chem.Mol(mol)
+
+    highlightAtomColors, cp = ExplainerExperiments.determine_atom_col(cp, atom_imp, eps=0.1, set_weights=set_weights)
+    highlightAtoms = list(highlightAtomColors.keys())
+
+    highlightBondColors = ExplainerExperiments.determine_bond_col(highlightAtomColors, mol)
+    highlightBonds = list(highlightBondColors.keys())
+
+    # only highlighted atoms are drawn with a radius
+    # highlightAtomRadii = {k: np.abs(v) * vis_factor for k, v in enumerate(atom_imp)}
+    highlightAtomRadii = dict.fromkeys(highlightAtoms, 0.1 * vis_factor)
+
+    # molecules that already carry a conformer keep their coordinates unless asked otherwise
+    if recompute_coords or cp.GetNumConformers() == 0:
+        rdDepictor.Compute2DCoords(cp, canonOrient=True)
+    # a fresh drawer per molecule, ClearDrawing() keeps the PNG metadata of earlier molecules
+    drawer = rdMolDraw2D.MolDraw2DCairo(img_width, img_height)
+    drawer.DrawMolecule(
+        cp,
+        highlightAtoms=highlightAtoms,
+        highlightAtomColors=highlightAtomColors,
+        highlightAtomRadii=highlightAtomRadii,
+        highlightBonds=highlightBonds,
+        highlightBondColors=highlightBondColors,
+    )
+    drawer.FinishDrawing()
+    return drawer.GetDrawingText()
+
+
+def _write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)